@@ -1,21 +1,21 @@
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, HTTPException, File, UploadFile
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 import os
-import openai
+import httpx
 from openai import AsyncOpenAI
-from typing import List, Dict, Any
-import json
+from typing import Dict, Set, Optional, Union, Any
+import re
+import zlib
+import orjson
 import asyncio
 import serial
 import serial.tools.list_ports
-import threading
-import time
+import serial_asyncio
 from datetime import datetime
-import pandas as pd
 import plotly.graph_objects as go
-import plotly.utils
 import logging
 from collections import deque
 import aiofiles
@@ -25,63 +25,116 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Initialize Async OpenAI client
-openai.api_key = os.getenv("OPENAI_API_KEY")
-client = AsyncOpenAI(api_key=openai.api_key) if openai.api_key else None
+# A shared HTTP/2 pool multiplexes concurrent chat streams over few connections
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    http_client=httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=512, max_keepalive_connections=256),
+        timeout=httpx.Timeout(60.0, connect=5.0)
+    )
+) if OPENAI_API_KEY else None
 
 app = FastAPI(title="Advanced OBD Diagnostic System")
 
 # Mount static assets and templates
 app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
+templates = Jinja2Templates(env=Environment(
+    loader=FileSystemLoader("templates"),
+    auto_reload=False,
+    bytecode_cache=FileSystemBytecodeCache(),
+    cache_size=400
+))
 
-# Global data storage
+# Global data storage, only touched from the event loop so no locking is needed
 serial_data_buffer = deque(maxlen=1000)  # Store last 1000 data points
-data_log = []
-serial_connection = None
-serial_thread = None
-is_reading_serial = False
+serial_transport = None
+serial_port = None  # Kept after the transport closes so status can still report it
+cached_index_html = None
+chart_cache_json = None  # Serialized chart, reset whenever the buffer changes
+chart_cache_deflated = None  # Compressed chart response, rebuilt with chart_cache_json
+broadcast_queue: Optional[asyncio.Queue] = None
+broadcaster_task: Optional[asyncio.Task] = None
+
+# Seconds a single client may take to accept a broadcast frame
+BROADCAST_SEND_TIMEOUT = 1.0
+
+# Serial samples waiting to be broadcast; the oldest is dropped when full
+BROADCAST_QUEUE_SIZE = 256
+
+# Maximum number of samples coalesced into one serial_batch frame
+BROADCAST_BATCH_SIZE = 64
+
+# zlib level for the chart response; WebSocket frames are too small to compress
+CHART_DEFLATE_LEVEL = 1
+
+# System prompt shared by every chat request
+SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are an expert OBD diagnostic assistant. Help users understand their vehicle diagnostics data."
+}
+
+# Matches the first numeric value in a line of serial data
+NUMBER_RE = re.compile(r'-?\d+\.?\d*')
 
 class ConnectionManager:
     """Advanced connection manager for multiple WebSocket connections."""
 
     def __init__(self) -> None:
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Set[WebSocket] = set()
         self.connection_ids: Dict[WebSocket, str] = {}
 
     async def connect(self, websocket: WebSocket, client_id: str = "") -> None:
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections.add(websocket)
         self.connection_ids[websocket] = client_id or f"client_{len(self.active_connections)}"
         logger.info(f"Client {self.connection_ids[websocket]} connected")
 
     def disconnect(self, websocket: WebSocket) -> None:
-        if websocket in self.active_connections:
-            client_id = self.connection_ids.get(websocket, "unknown")
-            self.active_connections.remove(websocket)
-            if websocket in self.connection_ids:
-                del self.connection_ids[websocket]
+        self.active_connections.discard(websocket)
+        client_id = self.connection_ids.pop(websocket, None)
+        if client_id is not None:
             logger.info(f"Client {client_id} disconnected")
 
-    async def send_personal_message(self, message: str, websocket: WebSocket) -> None:
+    async def send_personal_message(self, message: Union[str, bytes], websocket: WebSocket) -> None:
         try:
-            await websocket.send_text(message)
+            if isinstance(message, bytes):
+                await websocket.send_bytes(message)
+            else:
+                await websocket.send_text(message)
         except Exception as e:
             logger.error(f"Error sending message: {e}")
             self.disconnect(websocket)
 
-    async def broadcast(self, message: str) -> None:
+    async def broadcast(self, message: bytes) -> None:
         """Broadcast message to all connected clients."""
-        disconnected = []
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except Exception as e:
-                logger.error(f"Error broadcasting to client: {e}")
-                disconnected.append(connection)
+        connections = tuple(self.active_connections)
+        
+        # Send to every client concurrently so one slow client can't stall the rest
+        results = await asyncio.gather(
+            *(asyncio.wait_for(connection.send_bytes(message), timeout=BROADCAST_SEND_TIMEOUT)
+              for connection in connections),
+            return_exceptions=True
+        )
         
-        # Clean up disconnected clients
-        for connection in disconnected:
-            self.disconnect(connection)
+        # Drop failed or slow clients and close their sockets so they reconnect
+        failed = []
+        for connection, result in zip(connections, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error broadcasting to client: {result!r}")
+                self.disconnect(connection)
+                failed.append(connection)
+        
+        if failed:
+            await asyncio.gather(*(self.close_quietly(connection) for connection in failed))
+
+    async def close_quietly(self, websocket: WebSocket) -> None:
+        """Close a WebSocket with "try again later", ignoring errors on dead sockets."""
+        try:
+            await asyncio.wait_for(websocket.close(code=1013), timeout=BROADCAST_SEND_TIMEOUT)
+        except Exception as e:
+            logger.debug(f"Error closing client socket: {e!r}")
 
 manager = ConnectionManager()
 
@@ -90,48 +143,82 @@ def get_available_ports():
     ports = serial.tools.list_ports.comports()
     return [{"device": port.device, "description": port.description} for port in ports]
 
-def read_serial_data():
-    """Read data from serial port in a separate thread."""
-    global is_reading_serial, serial_connection, serial_data_buffer
-    
-    while is_reading_serial and serial_connection:
+def parse_json_message(message: str) -> Optional[Dict[str, Any]]:
+    """Decode a JSON WebSocket message, or return None for plain text."""
+    stripped = message.lstrip()
+    if not stripped.startswith("{"):
+        return None
+    try:
+        return orjson.loads(stripped)
+    except orjson.JSONDecodeError:
+        return None
+
+class SerialReader(asyncio.Protocol):
+    """Parse newline-delimited serial data and broadcast each line."""
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+
+    def connection_made(self, transport) -> None:
+        logger.info(f"Serial port {transport.serial.port} opened")
+
+    def data_received(self, data: bytes) -> None:
+        self.buffer.extend(data)
+        while True:
+            newline = self.buffer.find(b"\n")
+            if newline < 0:
+                break
+            raw = bytes(self.buffer[:newline])
+            del self.buffer[:newline + 1]
+            line = raw.decode("utf-8", errors="replace").strip()
+            if line:
+                self.handle_line(line)
+
+    def handle_line(self, line: str) -> None:
+        global chart_cache_json
+
+        timestamp = datetime.now().isoformat()
+        data_point = {
+            "timestamp": timestamp,
+            "data": line,
+            "raw": line
+        }
+
+        # Add to buffer
+        serial_data_buffer.append(data_point)
+        chart_cache_json = None
+
+        # Queue for broadcast, dropping the oldest sample to keep the stream live
         try:
-            if serial_connection.in_waiting > 0:
-                line = serial_connection.readline().decode('utf-8').strip()
-                if line:
-                    timestamp = datetime.now().isoformat()
-                    data_point = {
-                        "timestamp": timestamp,
-                        "data": line,
-                        "raw": line
-                    }
-                    
-                    # Add to buffer
-                    serial_data_buffer.append(data_point)
-                    
-                    # Add to log
-                    data_log.append(data_point)
-                    
-                    # Broadcast to all connected clients
-                    asyncio.run_coroutine_threadsafe(
-                        manager.broadcast(json.dumps({
-                            "type": "serial_data",
-                            "data": data_point
-                        })),
-                        asyncio.get_event_loop()
-                    )
-                    
-        except Exception as e:
-            logger.error(f"Error reading serial data: {e}")
-            is_reading_serial = False
-            break
-            
-        time.sleep(0.1)  # Small delay to prevent excessive CPU usage
+            broadcast_queue.put_nowait(data_point)
+        except asyncio.QueueFull:
+            broadcast_queue.get_nowait()
+            broadcast_queue.put_nowait(data_point)
+
+    def connection_lost(self, exc) -> None:
+        if exc:
+            logger.error(f"Error reading serial data: {exc}")
+        logger.info("Serial port closed")
+
+async def serial_broadcaster():
+    """Broadcast queued serial samples to all connected clients in batches."""
+    while True:
+        # Coalesce whatever arrived during the previous broadcast into one frame
+        batch = [await broadcast_queue.get()]
+        while len(batch) < BROADCAST_BATCH_SIZE and not broadcast_queue.empty():
+            batch.append(broadcast_queue.get_nowait())
+        
+        await manager.broadcast(orjson.dumps({
+            "type": "serial_batch",
+            "data": batch
+        }))
 
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
     """Serve the main application page."""
-    return templates.TemplateResponse("index.html", {"request": request})
+    if cached_index_html is None:
+        return templates.TemplateResponse("index.html", {"request": request})
+    return HTMLResponse(cached_index_html)
 
 @app.get("/api/ports")
 async def get_ports():
@@ -141,23 +228,22 @@ async def get_ports():
 @app.post("/api/serial/connect")
 async def connect_serial(request: Request):
     """Connect to a serial port."""
-    global serial_connection, serial_thread, is_reading_serial
+    global serial_transport, serial_port
     
     data = await request.json()
     port = data.get("port", "/dev/ttyUSB0")
     baud_rate = data.get("baud_rate", 9600)
     
     try:
-        if serial_connection and serial_connection.is_open:
-            serial_connection.close()
-        
-        serial_connection = serial.Serial(port, baud_rate, timeout=1)
-        is_reading_serial = True
+        if serial_transport:
+            serial_transport.close()
+            serial_transport = None
+            serial_port = None
         
-        # Start reading thread
-        serial_thread = threading.Thread(target=read_serial_data)
-        serial_thread.daemon = True
-        serial_thread.start()
+        serial_transport, _ = await serial_asyncio.create_serial_connection(
+            asyncio.get_running_loop(), SerialReader, port, baudrate=baud_rate
+        )
+        serial_port = port
         
         return {"success": True, "message": f"Connected to {port} at {baud_rate} baud"}
         
@@ -168,23 +254,28 @@ async def connect_serial(request: Request):
 @app.post("/api/serial/disconnect")
 async def disconnect_serial():
     """Disconnect from serial port."""
-    global serial_connection, is_reading_serial
+    global serial_transport, serial_port
     
-    is_reading_serial = False
-    
-    if serial_connection and serial_connection.is_open:
-        serial_connection.close()
-        serial_connection = None
+    if serial_transport:
+        serial_transport.close()
+        serial_transport = None
+        serial_port = None
         
     return {"success": True, "message": "Disconnected from serial port"}
 
 @app.get("/api/serial/status")
 async def get_serial_status():
     """Get current serial connection status."""
+    # The transport drops its serial object when the port is lost, e.g. on unplug
+    reading = (
+        serial_transport is not None
+        and not serial_transport.is_closing()
+        and serial_transport.serial is not None
+    )
     return {
-        "connected": serial_connection is not None and serial_connection.is_open if serial_connection else False,
-        "port": serial_connection.port if serial_connection else None,
-        "reading": is_reading_serial,
+        "connected": reading and serial_transport.serial.is_open,
+        "port": serial_port,
+        "reading": reading,
         "buffer_size": len(serial_data_buffer)
     }
 
@@ -195,26 +286,19 @@ async def get_recent_data():
 
 @app.get("/api/data/export")
 async def export_data():
-    """Export all collected data as JSON."""
-    return {"data": data_log, "count": len(data_log)}
+    """Export all buffered data as JSON."""
+    return {"data": list(serial_data_buffer), "count": len(serial_data_buffer)}
 
 @app.post("/api/data/clear")
 async def clear_data():
     """Clear all collected data."""
-    global data_log
-    data_log.clear()
+    global chart_cache_json
     serial_data_buffer.clear()
+    chart_cache_json = None
     return {"success": True, "message": "Data cleared"}
 
-@app.get("/api/data/chart")
-async def get_chart_data():
-    """Generate chart data for visualization."""
-    if not serial_data_buffer:
-        return {"error": "No data available"}
-    
-    # Convert to DataFrame for easier manipulation
-    df = pd.DataFrame(list(serial_data_buffer))
-    
+def build_chart_json() -> str:
+    """Build the Plotly chart for the buffered serial data as a JSON string."""
     # Create a simple line chart
     fig = go.Figure()
     
@@ -225,15 +309,11 @@ async def get_chart_data():
         timestamps = []
         
         for item in serial_data_buffer:
-            try:
-                # Try to extract numbers from the data string
-                import re
-                numbers = re.findall(r'-?\d+\.?\d*', item['data'])
-                if numbers:
-                    numeric_data.append(float(numbers[0]))
-                    timestamps.append(item['timestamp'])
-            except:
-                continue
+            # Use the first number in the data string
+            match = NUMBER_RE.search(item['data'])
+            if match is not None:
+                numeric_data.append(float(match.group(0)))
+                timestamps.append(item['timestamp'])
         
         if numeric_data:
             fig.add_trace(go.Scatter(
@@ -256,7 +336,49 @@ async def get_chart_data():
         height=400
     )
     
-    return {"chart": json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)}
+    return orjson.dumps(
+        fig.to_plotly_json(), option=orjson.OPT_SERIALIZE_NUMPY
+    ).decode()
+
+def accepts_deflate(accept_encoding: str) -> bool:
+    """Return True if an Accept-Encoding header allows a deflate response."""
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() != "deflate":
+            continue
+        # An explicit q=0 means the client refuses this coding
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+@app.get("/api/data/chart")
+async def get_chart_data(request: Request):
+    """Generate chart data for visualization."""
+    global chart_cache_json, chart_cache_deflated
+    
+    if not serial_data_buffer:
+        return {"error": "No data available"}
+    
+    # Rebuild and compress the chart only when the data has changed
+    if chart_cache_json is None:
+        chart_cache_json = build_chart_json()
+        chart_cache_deflated = zlib.compress(
+            orjson.dumps({"chart": chart_cache_json}), CHART_DEFLATE_LEVEL
+        )
+    
+    if accepts_deflate(request.headers.get("accept-encoding", "")):
+        return Response(
+            chart_cache_deflated,
+            media_type="application/json",
+            headers={"Content-Encoding": "deflate", "Vary": "Accept-Encoding"}
+        )
+    return JSONResponse({"chart": chart_cache_json}, headers={"Vary": "Accept-Encoding"})
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
@@ -266,9 +388,9 @@ async def websocket_endpoint(websocket: WebSocket):
     try:
         while True:
             message = await websocket.receive_text()
+            data = parse_json_message(message)
             
-            try:
-                data = json.loads(message)
+            if data is not None:
                 message_type = data.get("type", "chat")
                 
                 if message_type == "chat" and client:
@@ -279,25 +401,43 @@ async def websocket_endpoint(websocket: WebSocket):
                         response = await client.chat.completions.create(
                             model="gpt-3.5-turbo",
                             messages=[
-                                {"role": "system", "content": "You are an expert OBD diagnostic assistant. Help users understand their vehicle diagnostics data."},
+                                SYSTEM_MESSAGE,
                                 {"role": "user", "content": user_input}
                             ],
-                            max_tokens=500
+                            max_tokens=500,
+                            stream=True
                         )
                         
-                        assistant_reply = response.choices[0].message.content
+                        # Forward each token delta as soon as it arrives
+                        try:
+                            async for chunk in response:
+                                # Stop pulling tokens once the client has gone
+                                if websocket not in manager.active_connections:
+                                    break
+                                if not chunk.choices:
+                                    continue
+                                delta = chunk.choices[0].delta.content
+                                if delta:
+                                    await manager.send_personal_message(
+                                        orjson.dumps({
+                                            "type": "chat_delta",
+                                            "message": delta
+                                        }),
+                                        websocket
+                                    )
+                        finally:
+                            # Release the upstream stream even if we stopped early
+                            await response.close()
                         
-                        await manager.send_personal_message(
-                            json.dumps({
-                                "type": "chat_response",
-                                "message": assistant_reply
-                            }),
-                            websocket
-                        )
+                        if websocket in manager.active_connections:
+                            await manager.send_personal_message(
+                                orjson.dumps({"type": "chat_done"}),
+                                websocket
+                            )
                         
                     except Exception as e:
                         await manager.send_personal_message(
-                            json.dumps({
+                            orjson.dumps({
                                 "type": "error",
                                 "message": f"Error contacting AI: {str(e)}"
                             }),
@@ -308,10 +448,10 @@ async def websocket_endpoint(websocket: WebSocket):
                     # Handle serial commands
                     command = data.get("command", "")
                     
-                    if serial_connection and serial_connection.is_open:
-                        serial_connection.write(f"{command}\n".encode())
+                    if serial_transport and not serial_transport.is_closing():
+                        serial_transport.write(f"{command}\n".encode())
                         await manager.send_personal_message(
-                            json.dumps({
+                            orjson.dumps({
                                 "type": "serial_response",
                                 "message": f"Command sent: {command}"
                             }),
@@ -319,7 +459,7 @@ async def websocket_endpoint(websocket: WebSocket):
                         )
                     else:
                         await manager.send_personal_message(
-                            json.dumps({
+                            orjson.dumps({
                                 "type": "error",
                                 "message": "Serial port not connected"
                             }),
@@ -329,24 +469,24 @@ async def websocket_endpoint(websocket: WebSocket):
                 elif message_type == "ping":
                     # Handle ping for connection testing
                     await manager.send_personal_message(
-                        json.dumps({"type": "pong"}),
+                        orjson.dumps({"type": "pong"}),
                         websocket
                     )
                 
-            except json.JSONDecodeError:
+            else:
                 # Handle plain text messages (backwards compatibility)
                 if client:
                     try:
                         response = await client.chat.completions.create(
                             model="gpt-3.5-turbo",
                             messages=[
-                                {"role": "system", "content": "You are an expert OBD diagnostic assistant. Help users understand their vehicle diagnostics data."},
+                                SYSTEM_MESSAGE,
                                 {"role": "user", "content": message}
                             ],
                             max_tokens=500
                         )
                         
-                        assistant_reply = response.choices[0].message.content
+                        assistant_reply = response.choices[0].message.content or "No response generated"
                         await manager.send_personal_message(assistant_reply, websocket)
                         
                     except Exception as e:
@@ -361,8 +501,17 @@ async def websocket_endpoint(websocket: WebSocket):
 @app.on_event("startup")
 async def startup_event():
     """Initialize the application."""
+    global cached_index_html, broadcast_queue, broadcaster_task
+    
     logger.info("Advanced OBD Diagnostic System starting up...")
     
+    # Decouple serial reads from WebSocket fan-out
+    broadcast_queue = asyncio.Queue(maxsize=BROADCAST_QUEUE_SIZE)
+    broadcaster_task = asyncio.create_task(serial_broadcaster())
+    
+    # The index page has no per-request context, so render it once
+    cached_index_html = templates.get_template("index.html").render()
+    
     # Create data directory if it doesn't exist
     os.makedirs("data", exist_ok=True)
     
@@ -371,17 +520,35 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     """Clean up resources on shutdown."""
-    global is_reading_serial, serial_connection
+    global serial_transport
     
     logger.info("Shutting down...")
     
-    is_reading_serial = False
+    if serial_transport:
+        serial_transport.close()
+        serial_transport = None
+    
+    if broadcaster_task:
+        broadcaster_task.cancel()
     
-    if serial_connection and serial_connection.is_open:
-        serial_connection.close()
+    if client:
+        await client.close()
     
     logger.info("Shutdown complete!")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Serial state, buffers and WebSocket clients all live in this process,
+    # so every worker would see a different copy; keep it to one
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        # Behind a local reverse proxy, a Unix socket skips the TCP loopback stack
+        uds=os.getenv("UVICORN_UDS"),
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+        ws_per_message_deflate=False,
+        workers=1
+    )
\ No newline at end of file
@@ -9,6 +9,7 @@ class OBDDiagnosticApp {
         this.soundNotifications = false;
         this.dataBuffer = [];
         this.charts = {};
+        this.streamingMessage = null;
         
         this.initializeApp();
     }
@@ -25,6 +26,8 @@ class OBDDiagnosticApp {
     setupWebSocket() {
         const wsProtocol = window.location.protocol === 'https:' ? 'wss' : 'ws';
         this.ws = new WebSocket(`${wsProtocol}://${window.location.host}/ws`);
+        this.ws.binaryType = 'arraybuffer';
+        this.textDecoder = new TextDecoder();
         
         this.ws.onopen = () => {
             this.updateConnectionStatus(true);
@@ -32,10 +35,14 @@ class OBDDiagnosticApp {
         };
         
         this.ws.onmessage = (event) => {
-            this.handleWebSocketMessage(event.data);
+            // JSON frames arrive as binary, plain-text replies as text
+            const data = event.data instanceof ArrayBuffer ? this.textDecoder.decode(event.data) : event.data;
+            this.handleWebSocketMessage(data);
         };
         
         this.ws.onclose = () => {
+            // Don't append the next reply to a bubble cut off by the disconnect
+            this.streamingMessage = null;
             this.updateConnectionStatus(false);
             this.addTerminalLine('WebSocket disconnected', 'error');
             // Attempt to reconnect after 3 seconds
@@ -53,16 +60,23 @@ class OBDDiagnosticApp {
             const message = JSON.parse(data);
             
             switch (message.type) {
-                case 'serial_data':
-                    this.handleSerialData(message.data);
+                case 'serial_batch':
+                    this.handleSerialBatch(message.data);
                     break;
                 case 'chat_response':
                     this.addChatMessage(message.message, 'assistant');
                     break;
+                case 'chat_delta':
+                    this.appendChatDelta(message.message);
+                    break;
+                case 'chat_done':
+                    this.streamingMessage = null;
+                    break;
                 case 'serial_response':
                     this.addTerminalLine(message.message, 'system');
                     break;
                 case 'error':
+                    this.streamingMessage = null;
                     this.addTerminalLine(message.message, 'error');
                     break;
                 case 'pong':
@@ -77,19 +91,21 @@ class OBDDiagnosticApp {
         }
     }
 
-    handleSerialData(data) {
-        this.dataBuffer.push(data);
+    handleSerialBatch(batch) {
+        batch.forEach(data => {
+            this.dataBuffer.push(data);
+            this.addTerminalLine(`${data.timestamp}: ${data.data}`, 'output');
+        });
         
         // Keep only the last maxDataPoints
         if (this.dataBuffer.length > this.maxDataPoints) {
-            this.dataBuffer.shift();
+            this.dataBuffer.splice(0, this.dataBuffer.length - this.maxDataPoints);
         }
         
-        // Update various UI elements
+        // Update various UI elements once per batch
         this.updateRecentDataList();
         this.updateDataStats();
         this.updateRealtimeChart();
-        this.addTerminalLine(`${data.timestamp}: ${data.data}`, 'output');
         
         // Play sound notification if enabled
         if (this.soundNotifications) {
@@ -316,6 +332,18 @@ class OBDDiagnosticApp {
         chatMessages.scrollTop = chatMessages.scrollHeight;
     }
 
+    appendChatDelta(text) {
+        // Start a new assistant message on the first delta of a reply
+        if (!this.streamingMessage) {
+            this.addChatMessage('', 'assistant');
+            this.streamingMessage = document.getElementById('chatMessages').lastElementChild;
+        }
+        
+        const chatMessages = document.getElementById('chatMessages');
+        this.streamingMessage.textContent += text;
+        chatMessages.scrollTop = chatMessages.scrollHeight;
+    }
+
     addTerminalLine(text, type) {
         const terminal = document.getElementById('terminalOutput');
         const line = document.createElement('div');